@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import m2cgen as m2c
+import os
+import tempfile
+import shardedTraining
+
+# Checks the sharded training on a small synthetic feature file:
+#  - a shard that never sees a position still gives a usable tree
+#  - trees of empty shards move to the others, no training data is an error
+#  - too small a shard budget is an error instead of silent subsampling
+#  - the merged forest keeps n_estimators and its probabilities sum to 1
+#  - the test confusion matrix counts every held out row
+#  - m2cgen exports the merged forest
+def check_sharded_training():
+    rng = np.random.default_rng(0)
+    positions = [0, 1, 2, 3, 12, 13, 23, 123]
+    feature_columns = ['emg1_avg', 'emg2_avg', 'emg3_avg', 'pulse_avg']
+    n_estimators = 5
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Position 123 only has a handful of rows so most shards miss it
+        labels = np.concatenate([np.repeat(positions[:-1], 400), np.repeat(positions[-1], 3)])
+        data = pd.DataFrame(rng.normal(size=(len(labels), len(feature_columns))) + labels[:, None] * 0.05,
+                            columns=feature_columns)
+        data['Position'] = labels
+        data_path = os.path.join(tmp_dir, 'processed_data.csv')
+        data.to_csv(data_path, index=False)
+
+        # A shard without position 123 has its trees padded to every class
+        n_cols = len(feature_columns) + 1
+        shard = data[data['Position'] != 123].to_numpy(dtype=shardedTraining.DTYPE)
+        shard[:, -1] = np.searchsorted(positions, shard[:, -1])
+        shard_path = os.path.join(tmp_dir, 'shard.bin')
+        shard.tofile(shard_path)
+        sub_forest = shardedTraining.fit_shard(shard_path, n_cols, len(positions), 2, 42, {})
+        for tree in sub_forest.estimators_:
+            assert tree.tree_.value.shape[-1] == len(positions)
+            assert tree.n_classes_ == len(positions)
+
+        # Trees of an empty shard are handed to the non-empty ones
+        empty_path = os.path.join(tmp_dir, 'empty.bin')
+        open(empty_path, 'wb').close()
+        assert shardedTraining.assign_estimators([shard_path, empty_path, shard_path], 5) == [3, 0, 2]
+        try:
+            shardedTraining.assign_estimators([empty_path, empty_path], 5)
+            raise AssertionError('no training rows should raise')
+        except ValueError:
+            pass
+
+        model_params = {'n_estimators': n_estimators, 'random_state': 42}
+        split_params = {'test_size': 0.2, 'random_state': 42}
+        bytes_per_row = n_cols * 4 * shardedTraining.FIT_OVERHEAD
+
+        # 5 shards of 200 rows cannot cover ~2600 training rows
+        try:
+            shardedTraining.train_sharded_model(data_path, feature_columns, model_params, split_params,
+                                                200 * bytes_per_row, n_workers=2, work_dir=tmp_dir)
+            raise AssertionError('low row coverage should raise')
+        except ValueError:
+            pass
+
+        # Shards of 1500 rows, each a sample of the archive, cover it between them
+        model, test_matrix = shardedTraining.train_sharded_model(
+            data_path, feature_columns, model_params, split_params,
+            1500 * bytes_per_row, n_workers=2, work_dir=tmp_dir)
+
+        assert model.n_estimators == n_estimators
+        assert len(model.estimators_) == n_estimators
+        assert list(model.classes_) == positions
+        assert test_matrix.shape == (len(positions), len(positions))
+        assert 0.1 * len(data) < test_matrix.sum() < 0.3 * len(data)
+
+        X = data[feature_columns].to_numpy()
+        proba = model.predict_proba(X)
+        assert proba.shape == (len(X), len(positions))
+        assert np.allclose(proba.sum(axis=1), 1.0)
+        assert set(model.predict(X)) <= set(positions)
+
+        code = m2c.export_to_c(model, function_name="predict")
+        assert "void predict(double * input, double * output)" in code
+        assert f"double var0[{len(positions)}];" in code
+
+    print("Sharded training checks passed")
+
+if __name__ == '__main__':
+    check_sharded_training()
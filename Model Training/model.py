@@ -3,8 +3,39 @@ from sklearn.metrics import (accuracy_score, precision_score, recall_score,
                              f1_score, confusion_matrix, classification_report, matthews_corrcoef)
 from sklearn.model_selection import train_test_split
 import m2cgen as m2c
+import numpy as np
 import pandas as pd
+import sklearn
+import os
 import re
+import shutil
+import sys
+import modelStore
+import shardedTraining
+
+DATA_PATH = 'processed_data.csv'
+
+# Parameters that change the fitted forest (part of the model fingerprint)
+MODEL_PARAMS = {
+    'n_estimators': 15, #try 50 # was 100
+    #'max_depth': 10, #default is none
+    #'max_features': 3, # Fewer features per split, less memory
+    'random_state': 42,
+}
+
+# Train/test split settings, these change the training data and the metrics
+SPLIT_PARAMS = {
+    'test_size': 0.2,
+    'random_state': 42,
+}
+
+# Out-of-core training, used when the feature file is bigger than one
+# worker's memory budget (or with --sharded)
+SHARD_PARAMS = {
+    'shard_memory_bytes': 512 * 1024 ** 2, # memory budget for each worker
+    'n_workers': 4,
+    'min_row_coverage': 0.95, # fail rather than train on less of the data
+}
 
 # Train and test the model
 def train_model(X_train, y_train, X_test, y_test, feature_names):
@@ -12,10 +43,7 @@ def train_model(X_train, y_train, X_test, y_test, feature_names):
     rf_model = RandomForestClassifier(
         verbose=1,
         n_jobs=-1,
-        n_estimators=15, #try 50 # was 100
-        #max_depth = 10, #default is none
-        #max_features=3, # Fewer features per split, less memory
-        random_state=42
+        **MODEL_PARAMS
     )
 
     rf_model.fit(X_train, y_train)
@@ -28,21 +56,26 @@ def train_model(X_train, y_train, X_test, y_test, feature_names):
     print_performance_metrics(metrics_rf)
     #feature_importance(rf_model, X_train, feature_names)
 
-    return rf_model
+    return rf_model, metrics_rf
 
 # Useful values for classification
-def calculate_performance_metrics(y_test, y_pred):
+def calculate_performance_metrics(y_test, y_pred, sample_weight=None):
     metrics = {}
-    metrics['accuracy'] = accuracy_score(y_test, y_pred)
-    metrics['precision'] = precision_score(y_test, y_pred, average='weighted')
-    metrics['recall'] = recall_score(y_test, y_pred, average='weighted')
-    metrics['f1_score'] = f1_score(y_test, y_pred, average='weighted')
-    metrics['confusion_matrix'] = confusion_matrix(y_test, y_pred)
-    metrics['mcc'] = matthews_corrcoef(y_test, y_pred)
-    metrics['classification_report'] = classification_report(y_test, y_pred)
+    metrics['accuracy'] = accuracy_score(y_test, y_pred, sample_weight=sample_weight)
+    metrics['precision'] = precision_score(y_test, y_pred, average='weighted', sample_weight=sample_weight)
+    metrics['recall'] = recall_score(y_test, y_pred, average='weighted', sample_weight=sample_weight)
+    metrics['f1_score'] = f1_score(y_test, y_pred, average='weighted', sample_weight=sample_weight)
+    metrics['confusion_matrix'] = confusion_matrix(y_test, y_pred, sample_weight=sample_weight)
+    metrics['mcc'] = matthews_corrcoef(y_test, y_pred, sample_weight=sample_weight)
+    metrics['classification_report'] = classification_report(y_test, y_pred, sample_weight=sample_weight)
     
     return metrics
 
+# Same values from a confusion matrix, every (true, predicted) pair weighted by its count
+def calculate_metrics_from_confusion_matrix(matrix, classes):
+    y_test, y_pred = np.meshgrid(classes, classes, indexing='ij')
+    return calculate_performance_metrics(y_test.ravel(), y_pred.ravel(), sample_weight=matrix.ravel())
+
 # Prints all performance metrics
 def print_performance_metrics(metrics):
     print("Accuracy:", metrics.get('accuracy', "Not computed"))
@@ -353,29 +386,67 @@ def secondDropList(appender):
 
     return [emg1, emg2, emg3, pulse]
 
-# Trains the model
-def create_model():
-    # Load the data
-    processed_data = pd.read_csv('processed_data.csv')
+# All the columns that are not used as features
+def get_dropped_columns():
+    dropped = []
 
     # Dropping accelerometers
     for num in range(1, 16):
         i = str(num)
-        cur_drops = makeDropList(appender=i)
-        processed_data = processed_data.drop(columns=cur_drops)
-
-        cur_drops = secondDropList(appender=i)
-        processed_data = processed_data.drop(columns=cur_drops)
+        dropped += makeDropList(appender=i)
+        dropped += secondDropList(appender=i)
 
     # Dropping avg and var
-    processed_data = processed_data.drop(columns=makeDropList('avg'))
-    processed_data = processed_data.drop(columns=makeDropList('var'))
-    processed_data = processed_data.drop(columns=makeDropList('rms'))
-    processed_data = processed_data.drop(columns=secondDropList('rms'))
-    processed_data = processed_data.drop(columns=makeDropList('first_derivative'))
-    processed_data = processed_data.drop(columns=makeDropList('second_derivative'))
-    #processed_data = processed_data.drop(columns=secondDropList('first_derivative'))
-    #processed_data = processed_data.drop(columns=secondDropList('second_derivative'))
+    dropped += makeDropList('avg')
+    dropped += makeDropList('var')
+    dropped += makeDropList('rms')
+    dropped += secondDropList('rms')
+    dropped += makeDropList('first_derivative')
+    dropped += makeDropList('second_derivative')
+    #dropped += secondDropList('first_derivative')
+    #dropped += secondDropList('second_derivative')
+
+    return dropped
+
+# Fingerprint of the feature data, feature spec and forest parameters.
+# full_hash rereads the whole feature file instead of trusting the cached hash.
+def get_model_key(sharded=False, full_hash=False):
+    params = dict(MODEL_PARAMS, split=SPLIT_PARAMS, sklearn=sklearn.__version__)
+    if sharded:
+        # The worker count does not change the forest, the shard size does
+        params['shard_memory_bytes'] = SHARD_PARAMS['shard_memory_bytes']
+    return modelStore.make_fingerprint(DATA_PATH, get_dropped_columns(), params, full_hash=full_hash)
+
+# What gets stored next to a fitted model
+def make_model_info(feature_names, shard_params=None):
+    info = {
+        'data_path': DATA_PATH,
+        'feature_names': feature_names,
+        'model_params': MODEL_PARAMS,
+        'split_params': SPLIT_PARAMS,
+        'sklearn_version': sklearn.__version__,
+    }
+    if shard_params is not None:
+        info['shard_params'] = shard_params
+
+    return info
+
+# Trains the model, or finds it in the store if nothing changed.
+# A stored model is returned as None and only loaded if its export is missing.
+def create_model(force_retrain=False, sharded=False, full_hash=False):
+    model_key = get_model_key(sharded, full_hash)
+    if not force_retrain and modelStore.has_model(model_key):
+        print(f'Found stored model {model_key}')
+        print_performance_metrics(modelStore.load_metrics(model_key))
+        modelStore.set_latest(model_key)
+        return None, model_key
+
+    if sharded:
+        return create_sharded_model(model_key)
+
+    # Load the data
+    processed_data = pd.read_csv(DATA_PATH)
+    processed_data = processed_data.drop(columns=get_dropped_columns())
 
     # Separate data
     X = processed_data.drop(columns=['Position']).values
@@ -384,19 +455,39 @@ def create_model():
     feature_names = processed_data.columns[:-1].tolist()
 
     # Get test and train
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, **SPLIT_PARAMS)
 
     print('Read the data')
     # Run the model
-    model = train_model(X_train, y_train, X_test, y_test, feature_names)
+    model, metrics = train_model(X_train, y_train, X_test, y_test, feature_names)
 
-    return model
+    modelStore.save_model(model_key, model, metrics, make_model_info(feature_names))
+    print(f'Stored model {model_key}')
 
-# Formats the code correctly
-def create_model_code(model):
-    #Send the model to code
-    code = m2c.export_to_c(model, function_name="predict")
+    return model, model_key
+
+# Trains the model shard by shard so the whole feature file is never loaded
+def create_sharded_model(model_key):
+    # Only the header is read to work out the feature columns
+    dropped = set(get_dropped_columns())
+    header = pd.read_csv(DATA_PATH, nrows=0).columns
+    feature_names = [col for col in header if col not in dropped and col != 'Position']
+
+    model, test_matrix = shardedTraining.train_sharded_model(
+        DATA_PATH, feature_names, MODEL_PARAMS, SPLIT_PARAMS,
+        SHARD_PARAMS['shard_memory_bytes'], SHARD_PARAMS['n_workers'],
+        min_row_coverage=SHARD_PARAMS['min_row_coverage'])
 
+    metrics = calculate_metrics_from_confusion_matrix(test_matrix, model.classes_)
+    print_performance_metrics(metrics)
+
+    modelStore.save_model(model_key, model, metrics, make_model_info(feature_names, SHARD_PARAMS))
+    print(f'Stored model {model_key}')
+
+    return model, model_key
+
+# Formats the code correctly, reusing a stored export if the settings are unchanged
+def create_model_code(model, model_key=None):
     replacements = {
         "(double[]){1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0}": "defaultValues1",
         "(double[]){0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0}": "defaultValues2",
@@ -409,9 +500,6 @@ def create_model_code(model):
         "#include <string.h>": "",
     }
 
-    for old_val, new_val in replacements.items():
-        code = code.replace(old_val, new_val)
-
      # 5) assemble final code
     text_to_insert = ("double defaultValues1[8] = {1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0};"+
                     "\ndouble defaultValues2[8] = {0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0};"+
@@ -422,6 +510,31 @@ def create_model_code(model):
                     "\ndouble defaultValues7[8] = {0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0};"+
                     "\ndouble defaultValues8[8] = {0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0};\n")
 
+    file_path = "modelCode.txt"
+
+    # Export-only changes land under a new key, the fitted model is reused
+    export_key = modelStore.hash_value({
+        'replacements': replacements,
+        'text_to_insert': text_to_insert,
+        'm2cgen': m2c.__version__,
+    })[:16]
+    if model_key is not None and modelStore.has_export(model_key, export_key, file_path):
+        code = modelStore.load_export(model_key, export_key, file_path)
+        with open(file_path, "w") as file:
+            file.write(code)
+        print(f"Model code loaded from store {model_key}/{export_key}")
+        return
+
+    if model is None:
+        model = modelStore.load_model(model_key)
+        print(f"Loaded stored model {model_key}")
+
+    #Send the model to code
+    code = m2c.export_to_c(model, function_name="predict")
+
+    for old_val, new_val in replacements.items():
+        code = code.replace(old_val, new_val)
+
     # 6) Place #include lines at top
     includes = '#include "helpers.h"\n#include <cstring>\n#include <string.h>\n' + text_to_insert
     final_code = includes + code
@@ -430,22 +543,50 @@ def create_model_code(model):
     final_code = final_code.replace('input', 'modelInput')
     final_code = final_code.replace('output', 'modelOutput')
 
-    file_path = "modelCode.txt"
     with open(file_path, "w") as file:
         file.write(code)
 
+    if model_key is not None:
+        modelStore.save_export(model_key, export_key, file_path, code)
+
     print("Model code created")
     output_file = "adjustedModelCode.txt"
 
     #create_proper_code(file_path, replacements, output_file, text_to_insert)
     print("Model code adjusted")
 
-# Runs the model
-def run_model_training():
+# Feature files bigger than one worker's budget are trained shard by shard
+def needs_sharding():
+    return os.path.getsize(DATA_PATH) > SHARD_PARAMS['shard_memory_bytes']
+
+# Runs the model, sharded=None picks the mode from the feature file size
+def run_model_training(sharded=None, force_retrain=False, full_hash=False):
+    if sharded is None:
+        sharded = needs_sharding()
+
     # Train the model
-    model = create_model()
+    model, model_key = create_model(force_retrain, sharded, full_hash)
 
     # Make the code
-    create_model_code(model)
-
-run_model_training()
\ No newline at end of file
+    create_model_code(model, model_key)
+
+# Puts the newest stored export of the latest model back in modelCode.txt, no training
+def deploy_latest(file_path="modelCode.txt"):
+    export_path = modelStore.latest_export(file_path)
+    if export_path is None:
+        print("No stored model code to deploy")
+        return False
+
+    shutil.copyfile(export_path, file_path)
+    print_performance_metrics(modelStore.load_metrics(modelStore.latest_key()))
+    print(f"Deployed {export_path}")
+    return True
+
+# Guarded so the sharded training worker processes do not rerun the training
+# Flags: --deploy-latest, --sharded, --retrain, --full-hash
+if __name__ == '__main__':
+    if '--deploy-latest' in sys.argv:
+        deploy_latest()
+    else:
+        run_model_training(sharded=True if '--sharded' in sys.argv else None,
+                           force_retrain='--retrain' in sys.argv, full_hash='--full-hash' in sys.argv)
\ No newline at end of file
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import joblib
+
+# Where the fitted models and their exports live
+STORE_DIR = "Model Store"
+# Old artifacts are evicted once the store grows past this size
+DEFAULT_QUOTA_BYTES = 2 * 1024 ** 3
+
+MODEL_FILE = "model.joblib"
+METRICS_FILE = "metrics.json"
+INFO_FILE = "info.json"
+EXPORTS_DIR = "exports"
+LATEST_FILE = "latest.txt"
+HASH_CACHE_FILE = "file_hashes.json"
+
+
+# Stable hash of any json-able value
+def hash_value(value):
+    encoded = json.dumps(value, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+# Hashes a file in chunks so large feature files never sit in memory.
+# The hash is cached against the file's size, inode and mtime (in ns) so an
+# unchanged archive is not reread on every run; full_hash skips the cache.
+def hash_file(path, store_dir=STORE_DIR, full_hash=False, chunk_size=1 << 20):
+    stat = os.stat(path)
+    file_id = {'size': stat.st_size, 'inode': stat.st_ino, 'mtime_ns': stat.st_mtime_ns}
+    cache_path = os.path.join(store_dir, HASH_CACHE_FILE)
+    cache = read_json(cache_path, default={})
+    cache_key = os.path.abspath(path)
+    cached = cache.get(cache_key)
+    if not full_hash and cached and cached['file_id'] == file_id:
+        return cached['sha256']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    cache[cache_key] = {'file_id': file_id, 'sha256': digest.hexdigest()}
+    os.makedirs(store_dir, exist_ok=True)
+    write_json(cache_path, cache)
+    return digest.hexdigest()
+
+# Fingerprint of everything that changes the fitted model
+def make_fingerprint(data_path, feature_spec, model_params, store_dir=STORE_DIR, full_hash=False):
+    return hash_value({
+        'data': hash_file(data_path, store_dir, full_hash),
+        'features': feature_spec,
+        'params': model_params,
+    })[:16]
+
+def read_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_json(path, value):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(value, f, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+def artifact_dir(key, store_dir=STORE_DIR):
+    return os.path.join(store_dir, key)
+
+# Marks an artifact as recently used so eviction keeps it
+def touch(key, store_dir=STORE_DIR):
+    os.utime(artifact_dir(key, store_dir))
+
+def has_model(key, store_dir=STORE_DIR):
+    return os.path.exists(os.path.join(artifact_dir(key, store_dir), MODEL_FILE))
+
+# Loads a stored model. sklearn copies the tree arrays on unpickling, so the
+# whole forest ends up in memory; only load it when it is actually needed.
+def load_model(key, store_dir=STORE_DIR):
+    touch(key, store_dir)
+    return joblib.load(os.path.join(artifact_dir(key, store_dir), MODEL_FILE))
+
+def load_metrics(key, store_dir=STORE_DIR):
+    return read_json(os.path.join(artifact_dir(key, store_dir), METRICS_FILE))
+
+def load_info(key, store_dir=STORE_DIR):
+    return read_json(os.path.join(artifact_dir(key, store_dir), INFO_FILE))
+
+# Makes the metrics dict json friendly
+def serialize_metrics(metrics):
+    serialized = {}
+    for name, value in metrics.items():
+        if hasattr(value, 'tolist'):
+            value = value.tolist()
+        serialized[name] = value
+    return serialized
+
+# Saves a fitted model with its metrics and marks it as the latest
+def save_model(key, model, metrics, info, store_dir=STORE_DIR, quota_bytes=DEFAULT_QUOTA_BYTES):
+    os.makedirs(store_dir, exist_ok=True)
+    final_dir = artifact_dir(key, store_dir)
+
+    # Write into a temp folder first so a crash never leaves half an artifact
+    tmp_dir = final_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(os.path.join(tmp_dir, EXPORTS_DIR))
+
+    joblib.dump(model, os.path.join(tmp_dir, MODEL_FILE))
+    write_json(os.path.join(tmp_dir, METRICS_FILE), serialize_metrics(metrics))
+    write_json(os.path.join(tmp_dir, INFO_FILE), dict(info, key=key, created=time.time()))
+
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(tmp_dir, final_dir)
+
+    set_latest(key, store_dir)
+    evict(quota_bytes, store_dir, keep=[key])
+
+def export_path(key, export_key, file_name, store_dir=STORE_DIR):
+    return os.path.join(artifact_dir(key, store_dir), EXPORTS_DIR, export_key, file_name)
+
+def has_export(key, export_key, file_name, store_dir=STORE_DIR):
+    return os.path.exists(export_path(key, export_key, file_name, store_dir))
+
+def load_export(key, export_key, file_name, store_dir=STORE_DIR):
+    touch(key, store_dir)
+    with open(export_path(key, export_key, file_name, store_dir), 'r', encoding='utf-8') as f:
+        return f.read()
+
+# Keeps an exported C variant next to the model it came from
+def save_export(key, export_key, file_name, code, store_dir=STORE_DIR, quota_bytes=DEFAULT_QUOTA_BYTES):
+    path = export_path(key, export_key, file_name, store_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(code)
+    os.replace(tmp_path, path)
+    touch(key, store_dir)
+
+    # Exports count towards the quota too
+    evict(quota_bytes, store_dir, keep=[key])
+
+def set_latest(key, store_dir=STORE_DIR):
+    with open(os.path.join(store_dir, LATEST_FILE), 'w', encoding='utf-8') as f:
+        f.write(key)
+
+def latest_key(store_dir=STORE_DIR):
+    path = os.path.join(store_dir, LATEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        key = f.read().strip()
+    return key if has_model(key, store_dir) else None
+
+# Path of the newest exported C for the latest model, this is what gets deployed
+def latest_export(file_name="modelCode.txt", store_dir=STORE_DIR):
+    key = latest_key(store_dir)
+    if key is None:
+        return None
+
+    exports_dir = os.path.join(artifact_dir(key, store_dir), EXPORTS_DIR)
+    paths = [os.path.join(exports_dir, export_key, file_name) for export_key in os.listdir(exports_dir)]
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        return None
+    return max(paths, key=os.path.getmtime)
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+# Removes the least recently used artifacts until the store fits the quota
+def evict(quota_bytes=DEFAULT_QUOTA_BYTES, store_dir=STORE_DIR, keep=()):
+    if not os.path.isdir(store_dir):
+        return []
+
+    keep = set(keep)
+    latest = latest_key(store_dir)
+    if latest is not None:
+        keep.add(latest)
+
+    artifacts = []
+    for name in os.listdir(store_dir):
+        path = os.path.join(store_dir, name)
+        if os.path.isdir(path) and not name.endswith('.tmp'):
+            artifacts.append((os.path.getmtime(path), name, dir_size(path)))
+
+    total = sum(size for _, _, size in artifacts)
+    evicted = []
+    for _, name, size in sorted(artifacts):
+        if total <= quota_bytes:
+            break
+        if name in keep:
+            continue
+        shutil.rmtree(os.path.join(store_dir, name), ignore_errors=True)
+        total -= size
+        evicted.append(name)
+        print(f"Evicted model {name}")
+
+    return evicted
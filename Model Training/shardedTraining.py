@@ -0,0 +1,224 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.tree._tree import Tree
+import numpy as np
+import pandas as pd
+import math
+import os
+import shutil
+import tempfile
+
+# Rows are stored as float32 (what the trees use internally) with the label index last
+DTYPE = np.float32
+# Fitting copies the shard and builds the trees next to it, so leave headroom
+FIT_OVERHEAD = 3
+
+# How many rows fit in one worker's memory budget
+def rows_per_shard(n_features, shard_memory_bytes):
+    bytes_per_row = (n_features + 1) * np.dtype(DTYPE).itemsize * FIT_OVERHEAD
+    return max(1, shard_memory_bytes // bytes_per_row)
+
+# Reads only the label column to get the row count and every class
+def scan_labels(data_path, chunk_rows):
+    n_rows = 0
+    classes = set()
+    for chunk in pd.read_csv(data_path, usecols=['Position'], chunksize=chunk_rows):
+        n_rows += len(chunk)
+        classes.update(chunk['Position'].unique().tolist())
+
+    return n_rows, np.array(sorted(classes))
+
+# Fraction of the training rows each shard samples, and the expected share of
+# rows that end up in at least one shard
+def shard_sampling(n_train_rows, shard_rows, n_shards):
+    fraction = min(1.0, shard_rows / n_train_rows) if n_train_rows else 1.0
+    coverage = 1.0 - (1.0 - fraction) ** n_shards
+    return fraction, coverage
+
+# One tree per shard; the trees of empty shards move to the non-empty ones
+def assign_estimators(shard_paths, n_estimators):
+    non_empty = [i for i, path in enumerate(shard_paths) if os.path.getsize(path) > 0]
+    if not non_empty:
+        raise ValueError('No training rows left after the test split, the feature file is too small')
+
+    counts = [0] * len(shard_paths)
+    for tree in range(n_estimators):
+        counts[non_empty[tree % len(non_empty)]] += 1
+    return counts
+
+def read_rows(path, n_cols):
+    return np.memmap(path, dtype=DTYPE, mode='r').reshape(-1, n_cols)
+
+# Streams the csv once and samples the shard files from it. Every training row
+# goes into each shard with probability sample_fraction, so each shard is a
+# random draw over the whole archive (like max_samples per tree). The archive
+# is written grouped by orientation, so contiguous shards would each only see
+# a few positions.
+def scatter_shards(data_path, feature_columns, classes, n_shards, chunk_rows, test_size, random_state, work_dir,
+                   sample_fraction=1.0):
+    rng = np.random.default_rng(random_state)
+    n_cols = len(feature_columns) + 1
+
+    shard_paths = [os.path.join(work_dir, f'shard_{i}.bin') for i in range(n_shards)]
+    test_path = os.path.join(work_dir, 'test.bin')
+    shard_files = [open(path, 'wb') for path in shard_paths]
+    test_file = open(test_path, 'wb')
+
+    try:
+        dtypes = {col: DTYPE for col in feature_columns}
+        for chunk in pd.read_csv(data_path, usecols=feature_columns + ['Position'], dtype=dtypes, chunksize=chunk_rows):
+            rows = np.empty((len(chunk), n_cols), dtype=DTYPE)
+            rows[:, :-1] = chunk[feature_columns].to_numpy(dtype=DTYPE)
+            rows[:, -1] = np.searchsorted(classes, chunk['Position'].to_numpy())
+
+            test_mask = rng.random(len(rows)) < test_size
+            test_file.write(rows[test_mask].tobytes())
+
+            train_rows = rows[~test_mask]
+            for shard_file in shard_files:
+                if sample_fraction < 1.0:
+                    shard_file.write(train_rows[rng.random(len(train_rows)) < sample_fraction].tobytes())
+                else:
+                    shard_file.write(train_rows.tobytes())
+    finally:
+        for shard_file in shard_files:
+            shard_file.close()
+        test_file.close()
+
+    return shard_paths, test_path
+
+# Rebuilds a tree's value array so it covers every class, not just the ones in its shard
+def pad_tree_classes(tree, shard_classes, n_classes):
+    state = tree.tree_.__getstate__()
+    values = state['values']
+    padded = np.zeros((values.shape[0], values.shape[1], n_classes), dtype=values.dtype)
+    padded[:, :, shard_classes] = values
+    state['values'] = padded
+
+    new_tree = Tree(tree.n_features_in_, np.array([n_classes], dtype=np.intp), 1)
+    new_tree.__setstate__(state)
+    tree.tree_ = new_tree
+    tree.classes_ = np.arange(n_classes, dtype=np.float64)
+    tree.n_classes_ = n_classes
+
+# Worker: fits a sub-forest on one shard, only this shard is ever in memory
+def fit_shard(shard_path, n_cols, n_classes, n_estimators, random_state, model_params, max_rows=None):
+    rows = read_rows(shard_path, n_cols)
+    # The random sampling can overshoot the budget a little, trim it back down
+    if max_rows is not None and len(rows) > max_rows:
+        keep = np.random.default_rng(random_state).choice(len(rows), size=max_rows, replace=False)
+        rows = rows[np.sort(keep)]
+    rows = np.array(rows)
+    X = rows[:, :-1]
+    y = rows[:, -1].astype(np.intp)
+    del rows
+
+    params = dict(model_params, n_estimators=n_estimators, random_state=random_state)
+    sub_forest = RandomForestClassifier(n_jobs=1, **params)
+    sub_forest.fit(X, y)
+
+    # Label indices the shard actually saw, in the order of the tree outputs
+    shard_classes = sub_forest.classes_.astype(np.intp)
+    if len(shard_classes) != n_classes:
+        for tree in sub_forest.estimators_:
+            pad_tree_classes(tree, shard_classes, n_classes)
+
+    return sub_forest
+
+# Combines the sub-forests into one forest over all the classes.
+# The merged forest only supports predict/predict_proba and the C export; the
+# per-tree sample state (estimators_samples_, OOB) is removed since each tree
+# was drawn from a different shard.
+def merge_forests(sub_forests, classes):
+    merged = sub_forests[0]
+    merged.estimators_ = [tree for sub_forest in sub_forests for tree in sub_forest.estimators_]
+    merged.n_estimators = len(merged.estimators_)
+    merged.classes_ = classes
+    merged.n_classes_ = len(classes)
+    merged.n_jobs = -1
+
+    for attr in ('_n_samples', '_n_samples_bootstrap', 'oob_score_', 'oob_decision_function_'):
+        if hasattr(merged, attr):
+            delattr(merged, attr)
+
+    return merged
+
+# Predicts the held out rows in shard sized chunks and counts them in a
+# confusion matrix (rows are true classes, columns predicted) so memory does
+# not grow with the test set
+def predict_test_rows(model, test_path, n_cols, chunk_rows, classes):
+    n_classes = len(classes)
+    matrix = np.zeros((n_classes, n_classes), dtype=np.int64)
+    if os.path.getsize(test_path) == 0:
+        return matrix
+
+    test_rows = read_rows(test_path, n_cols)
+    for start in range(0, len(test_rows), chunk_rows):
+        chunk = np.asarray(test_rows[start:start + chunk_rows])
+        true_idx = chunk[:, -1].astype(np.intp)
+        pred_idx = np.searchsorted(classes, model.predict(chunk[:, :-1]))
+        matrix += np.bincount(true_idx * n_classes + pred_idx, minlength=n_classes ** 2).reshape(n_classes, n_classes)
+
+    return matrix
+
+# Trains a forest on a feature file larger than RAM.
+# There is one shard per tree, each a random sample of at most shard_rows drawn
+# over the whole archive, so the forest keeps n_estimators trees and peak
+# memory is about n_workers shards plus the trees, whatever the archive size.
+# Fails when the shards together would be expected to miss more than
+# 1 - min_row_coverage of the training rows, rather than silently subsampling.
+def train_sharded_model(data_path, feature_columns, model_params, split_params,
+                        shard_memory_bytes, n_workers=None, work_dir=None, min_row_coverage=0.95):
+    n_cols = len(feature_columns) + 1
+    shard_rows = rows_per_shard(len(feature_columns), shard_memory_bytes)
+    n_workers = n_workers or os.cpu_count()
+
+    n_rows, classes = scan_labels(data_path, shard_rows)
+    n_train_rows = n_rows * (1 - split_params['test_size'])
+    n_shards = model_params['n_estimators']
+    sample_fraction, coverage = shard_sampling(n_train_rows, shard_rows, n_shards)
+    if coverage < min_row_coverage:
+        raise ValueError(
+            f'{n_shards} shards of {shard_rows} rows would only cover about {coverage:.1%} of the '
+            f'{math.ceil(n_train_rows)} training rows (min_row_coverage is {min_row_coverage:.0%}). '
+            'Raise shard_memory_bytes or n_estimators, or lower min_row_coverage.')
+    print(f'Training on {n_rows} rows in {n_shards} shards of about '
+          f'{math.ceil(min(n_train_rows, shard_rows))} rows, covering about {coverage:.1%} of the training rows')
+
+    work_dir = tempfile.mkdtemp(prefix='shards_', dir=work_dir)
+    try:
+        shard_paths, test_path = scatter_shards(
+            data_path, feature_columns, classes, n_shards, shard_rows,
+            split_params['test_size'], split_params['random_state'], work_dir, sample_fraction)
+
+        seed = model_params.get('random_state') or 0
+        shard_estimators = assign_estimators(shard_paths, model_params['n_estimators'])
+
+        # Keep at most n_workers shards in flight so memory stays bounded
+        sub_forests = [None] * n_shards
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            pending = {}
+            for i, shard_path in enumerate(shard_paths):
+                if len(pending) >= n_workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        sub_forests[pending.pop(future)] = future.result()
+
+                if shard_estimators[i] == 0:
+                    continue
+                future = executor.submit(fit_shard, shard_path, n_cols, len(classes),
+                                         shard_estimators[i], seed + i, model_params, shard_rows)
+                pending[future] = i
+
+            for future in pending:
+                sub_forests[pending[future]] = future.result()
+
+        sub_forests = [sub_forest for sub_forest in sub_forests if sub_forest is not None]
+        model = merge_forests(sub_forests, classes)
+        print(f'Merged {len(sub_forests)} sub-forests into {model.n_estimators} trees')
+
+        test_matrix = predict_test_rows(model, test_path, n_cols, shard_rows, classes)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return model, test_matrix